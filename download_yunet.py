@@ -0,0 +1,40 @@
+import hashlib
+import os
+import sys
+import tempfile
+import urllib.request
+
+import cv2
+
+# Optional setup step: web.py uses YuNet when this model exists and OpenCV's bundled Haar cascade otherwise.
+# Pin the model to an opencv_zoo commit and its checksum, e.g.
+#   YUNET_MODEL_URL=https://github.com/opencv/opencv_zoo/raw/<commit>/models/face_detection_yunet/face_detection_yunet_2023mar.onnx
+#   YUNET_MODEL_SHA256=<sha256 of that file>
+url = os.environ.get('YUNET_MODEL_URL')
+sha256 = os.environ.get('YUNET_MODEL_SHA256')
+dst = os.environ.get('YUNET_MODEL_PATH', 'models/face_detection_yunet_2023mar.onnx')
+timeout = 60
+
+
+if __name__ == "__main__":
+    if not url or not sha256:
+        sys.exit("Set YUNET_MODEL_URL to a commit-pinned model URL and YUNET_MODEL_SHA256 to its checksum.")
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+
+    # Download next to the destination and only move it into place once it is verified,
+    # so an interrupted download never leaves a truncated model behind.
+    fd, tmp_path = tempfile.mkstemp(suffix='.onnx', dir=os.path.dirname(dst) or '.')
+    try:
+        digest = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as f, urllib.request.urlopen(url, timeout=timeout) as response:
+            for chunk in iter(lambda: response.read(1 << 16), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        if digest.hexdigest() != sha256.lower():
+            sys.exit(f"Checksum mismatch for {url}: got {digest.hexdigest()}")
+        cv2.FaceDetectorYN.create(tmp_path, "", (0, 0))
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f'YuNet model saved as {dst}')
@@ -0,0 +1,32 @@
+import importlib.util
+import os
+import sys
+import onnxruntime as ort
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+src = os.path.join(os.path.expanduser(os.environ.get('U2NET_HOME', '~/.u2net')), 'u2net.onnx')
+dst = os.environ.get('REMBG_MODEL_PATH', 'models/u2net.quant.onnx')
+slim_dst = os.environ.get('REMBG_SLIM_MODEL_PATH', 'models/u2net.slim.onnx')
+
+
+if __name__ == "__main__":
+    if not os.path.exists(src):
+        sys.exit(f"{src} not found. Run the app once so rembg downloads it.")
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    # Slimming is optional (pip install onnxslim); without it the original graph is quantized.
+    if importlib.util.find_spec('onnxslim') is not None:
+        import onnxslim
+        os.makedirs(os.path.dirname(slim_dst), exist_ok=True)
+        onnxslim.slim(src, output_model=slim_dst)
+        print(f'Slimmed model saved as {slim_dst}')
+        src = slim_dst
+    else:
+        print('onnxslim is not installed; quantizing the original graph.')
+    # uint8 weights: onnxruntime's CPU ConvInteger kernel does not support int8 weights in every release.
+    quantize_dynamic(src, dst, weight_type=QuantType.QUInt8)
+    try:
+        ort.InferenceSession(dst, providers=['CPUExecutionProvider'])
+    except Exception as e:
+        os.remove(dst)
+        sys.exit(f"The quantized model could not be loaded by onnxruntime {ort.__version__}: {e}")
+    print(f'Quantized model saved as {dst}')
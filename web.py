@@ -1,77 +1,174 @@
 import streamlit as st
-from rembg import remove
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from PIL import Image
 import os
-from mtcnn import MTCNN
 import numpy as np
 import io
+import cv2
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 
 err_msg = None
+# rembg pulls in onnxruntime; it is imported lazily in get_rembg_session so reruns stay cheap.
+REMBG_AVAILABLE = importlib.util.find_spec('rembg') is not None
+DETECTION_MAX_SIDE = 640
+QUANTIZED_MODEL_PATH = os.environ.get('REMBG_MODEL_PATH', 'models/u2net.quant.onnx')
+SLIM_MODEL_PATH = os.environ.get('REMBG_SLIM_MODEL_PATH', 'models/u2net.slim.onnx')
+# Optional YuNet model fetched by download_yunet.py; without it the Haar cascade bundled with OpenCV is used.
+YUNET_MODEL_PATH = os.environ.get('YUNET_MODEL_PATH', 'models/face_detection_yunet_2023mar.onnx')
+MAX_WORKERS = 4
+# Fast baseline JPEG encoding; pillow-simd can replace pillow as a drop-in for a faster encoder.
+JPEG_SAVE_OPTIONS = {'format': 'JPEG', 'quality': 88, 'optimize': False, 'progressive': False, 'subsampling': 2}
+
+
+@st.cache_resource
+def get_detector():
+    if os.path.exists(YUNET_MODEL_PATH):
+        return cv2.FaceDetectorYN.create(YUNET_MODEL_PATH, "", (0, 0))
+    print(f"{YUNET_MODEL_PATH} not found, using OpenCV's Haar cascade. Run download_yunet.py for YuNet.")
+    return cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml'))
+
+
+# The cached detector is shared by every session and thread but is not safe to call concurrently,
+# so its lock has to be process-wide too.
+@st.cache_resource
+def get_detector_lock():
+    return threading.Lock()
+
+
+@st.cache_resource
+def get_rembg_session():
+    import onnxruntime as ort
+    from rembg import new_session
+    from rembg.sessions import U2netCustomSession
+
+    # CUDA is used when onnxruntime-gpu is installed, otherwise this falls back to CPU:
+    #   pip install rembg[gpu] && pip uninstall onnxruntime && pip install onnxruntime-gpu
+    # Pick the GPU with CUDA_VISIBLE_DEVICES.
+    available = ort.get_available_providers()
+    providers = [p for p in ('CUDAExecutionProvider', 'CPUExecutionProvider') if p in available]
+    # Prefer the models written by quantize_model.py: slimmed on GPU, slimmed + uint8 on CPU.
+    model_path = SLIM_MODEL_PATH if 'CUDAExecutionProvider' in available else QUANTIZED_MODEL_PATH
+    if os.path.exists(model_path):
+        sess_opts = ort.SessionOptions()
+        sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        try:
+            return U2netCustomSession("u2net_custom", sess_opts, providers, model_path=model_path)
+        except Exception as e:
+            print(f"Could not load {model_path}, using the stock u2net model: {e}")
+    return new_session("u2net", providers=providers)
 
 
-def remove_background(input_file):
+def read_input(input_file):
     if isinstance(input_file, str):
         input_path = os.path.join('original', input_file)
         if not os.path.exists(input_path):
             raise FileNotFoundError(f"The file {input_path} does not exist.")
         with open(input_path, 'rb') as f:
-            input_img = f.read()
+            return f.read()
     elif hasattr(input_file, 'name'):
-        input_img = input_file.read()
+        return input_file.getvalue() if hasattr(input_file, 'getvalue') else input_file.read()
     else:
         raise ValueError("Input must be a filename string or a file-like object with a 'name' attribute.")
 
-    output_path = f'masked/img_maske.png'
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    subject = remove(input_img, alpha_matting=True, alpha_matting_background_threshold=800)
+def remove_background(input_file, alpha_matting=False):
+    if not REMBG_AVAILABLE:
+        raise ImportError("rembg is not installed. Install it with: pip install rembg")
+    from rembg import remove
+
+    input_img = input_file if isinstance(input_file, bytes) else read_input(input_file)
+    input_img = cv2.imdecode(np.frombuffer(input_img, np.uint8), cv2.IMREAD_COLOR)
+    if input_img is None:
+        raise ValueError("The input could not be decoded as an image.")
+    input_img = cv2.cvtColor(input_img, cv2.COLOR_BGR2RGB)
 
-    with open(output_path, 'wb') as f:
-        f.write(subject)
+    if alpha_matting:
+        subject = remove(input_img, session=get_rembg_session(), alpha_matting=True,
+                         alpha_matting_foreground_threshold=240,
+                         alpha_matting_background_threshold=10,
+                         alpha_matting_erode_size=10)
+    else:
+        subject = remove(input_img, session=get_rembg_session())
+
+    # rembg returns an RGBA array when given an array.
+    return subject
 
-    return output_path
 
 def detect_face_and_crop(img_path):
     global err_msg
-    if isinstance(img_path, str):
-        foreground_img = Image.open(img_path).convert("RGBA")
-        err_msg = "No face detected with face_recognition. Using MTCNN as fallback."
-
-        detector = MTCNN()
+    if isinstance(img_path, np.ndarray):
+        foreground = img_path
+    elif isinstance(img_path, Image.Image):
+        foreground = np.asarray(img_path if img_path.mode == "RGBA" else img_path.convert("RGBA"))
+    elif isinstance(img_path, str):
+        foreground = np.asarray(Image.open(img_path).convert("RGBA"))
+    else:
+        raise TypeError("Input must be an image array, a PIL image or a file path.")
+    height, width = foreground.shape[:2]
+    err_msg = "No face detected with face_recognition. Using YuNet as fallback."
 
-        rgb_image = np.array(foreground_img.convert("RGB"))
+    detector = get_detector()
 
-        faces = detector.detect_faces(rgb_image)
+    # Detect on a downscaled copy; the crop still comes from the full-size image.
+    scale = min(1.0, DETECTION_MAX_SIDE / max(width, height))
+    detection_img = foreground
+    if scale < 1.0:
+        detection_img = cv2.resize(foreground, (int(width * scale), int(height * scale)),
+                                   interpolation=cv2.INTER_LINEAR)
 
-        if faces:
-            face = faces[0]
-            x, y, w, h = face['box']
-            h_pad = int(h * 0.9)
-            w_pad = int(w * 0.9)
-            lower_y = max(0, y - h_pad)
-            upper_y = min(foreground_img.height, y + h + h_pad)
-            lower_x = max(0, x - w_pad)
-            upper_x = min(foreground_img.width, x + w + w_pad)
+    # YuNet expects BGR input.
+    bgr_image = np.ascontiguousarray(detection_img[..., 2::-1])
 
-            face_crop = foreground_img.crop((lower_x, lower_y, upper_x, upper_y))
-            return face_crop
+    with get_detector_lock():
+        if isinstance(detector, cv2.CascadeClassifier):
+            faces = detector.detectMultiScale(cv2.cvtColor(bgr_image, cv2.COLOR_BGR2GRAY))
         else:
-            err_msg = "No face detected with either method. Returning original image."
-            return None
+            detector.setInputSize((bgr_image.shape[1], bgr_image.shape[0]))
+            _, faces = detector.detect(bgr_image)
+
+    if faces is not None and len(faces):
+        boxes = (faces[:, :4] / scale).astype(int)
+        pad = (boxes[:, 2:] * 0.9).astype(int)
+        lower = np.clip(boxes[:, :2] - pad, 0, None)
+        upper = np.clip(boxes[:, :2] + boxes[:, 2:] + pad, 0, (width, height))
+        lower_x, lower_y = lower[0].tolist()
+        upper_x, upper_y = upper[0].tolist()
+
+        face_crop = Image.fromarray(foreground[lower_y:upper_y, lower_x:upper_x])
+        return face_crop
+    else:
+        err_msg = "No face detected with either method. Returning original image."
+        return None
 
 
-def resize_and_center_image(img, target_size):
-    img_aspect_ratio = img.width / img.height
-    target_aspect_ratio = target_size[0] / target_size[1]
+def resize_image(img, size):
+    if size[0] * size[1] < img.width * img.height:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LANCZOS4
+    if img.mode != 'RGBA':
+        return Image.fromarray(cv2.resize(np.asarray(img), size, interpolation=interpolation))
+
+    # Resize with premultiplied alpha, as PIL does, so the black RGB of transparent pixels
+    # does not bleed into the edges of the cutout.
+    out = cv2.resize(np.asarray(img.convert('RGBa')), size, interpolation=interpolation)
+    return Image.fromarray(out, 'RGBa').convert('RGBA')
+
 
-    if img_aspect_ratio > target_aspect_ratio:
+def resize_and_center_image(img, target_size):
+    # Compare aspect ratios by cross-multiplying so exact matches are not lost to float rounding.
+    if img.width * target_size[1] > target_size[0] * img.height:
         new_height = target_size[1]
-        new_width = int(new_height * img_aspect_ratio)
+        new_width = (img.width * new_height + img.height // 2) // img.height
     else:
         new_width = target_size[0]
-        new_height = int(new_width / img_aspect_ratio)
+        new_height = (img.height * new_width + img.width // 2) // img.width
 
-    resized_img = img.resize((new_width, new_height), Image.LANCZOS)
+    resized_img = resize_image(img, (new_width, new_height))
+    if (new_width, new_height) == tuple(target_size):
+        return resized_img if resized_img.mode == 'RGBA' else resized_img.convert('RGBA')
 
     new_img = Image.new('RGBA', target_size, (0, 0, 0, 0))
     paste_x = (target_size[0] - new_width) // 2
@@ -88,41 +185,53 @@ def add_background(foreground, background_color, target_size):
 
 
 def add_background1(foreground, background_file, target_size):
-    background = Image.open(background_file).convert("RGBA")
-    background = background.resize(target_size, Image.LANCZOS)
+    background = Image.open(background_file).resize(target_size, Image.BILINEAR).convert("RGB")
     background.paste(foreground, (0, 0), foreground)
-    return background.convert("RGB")
+    return background
+
+
+@st.cache_data(max_entries=32)
+def process_image_cached(img_bytes, background, target_size, alpha_matting=False):
+    masked_img = remove_background(img_bytes, alpha_matting)
+
+    cropped_img = detect_face_and_crop(masked_img)
+    if cropped_img is None:
+        return None
+    resized_img = resize_and_center_image(cropped_img, target_size)
+
+    if isinstance(background, str) and background.startswith('#'):
+        return add_background(resized_img, background, target_size)
+    return add_background1(resized_img, os.path.join('bg', background), target_size)
 
 
-def process_image(input_files, background, output_path, target_size=(350, 450)):
+def process_image(input_files, background, output_path, target_size=(350, 450), alpha_matting=False):
     processed_images = []
 
     if not isinstance(input_files, list):
         input_files = [input_files]
 
-    for input_file in input_files:
-        try:
-            img_path = remove_background(input_file)
+    def process_one(input_file):
+        return process_image_cached(read_input(input_file), background, tuple(target_size), alpha_matting)
+
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(input_files))),
+                            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as executor:
+        futures = [executor.submit(process_one, input_file) for input_file in input_files]
 
+    for input_file, future in zip(input_files, futures):
+        try:
             if isinstance(input_file, str):
                 img_name = input_file
             else:
                 img_name = input_file.name
 
-            cropped_img = detect_face_and_crop(img_path)
-            if cropped_img is None:
+            final_img = future.result()
+            if final_img is None:
                 print(f"No face detected in {img_name}")
                 return None
-            resized_img = resize_and_center_image(cropped_img, target_size)
-
-            if isinstance(background, str) and background.startswith('#'):
-                final_img = add_background(resized_img, background, target_size)
-            else:
-                bg_path = os.path.join('bg', background)
-                final_img = add_background1(resized_img, bg_path, target_size)
 
             output_file = f"{output_path}"
-            final_img.save(output_file, format='jpeg')
+            final_img.save(output_file, **JPEG_SAVE_OPTIONS)
             print(f'Image processing complete. Saved as {output_file}')
 
             processed_images.append(final_img)
@@ -145,12 +254,12 @@ def clear_fields():
     st.experimental_rerun()
 
 
+@st.cache_data(ttl=60)
 def load_images(image_directory):
-    images = []
-    for filename in os.listdir(image_directory):
-        if filename.endswith(('png', 'jpg', 'jpeg')):
-            images.append(filename)
-    return images
+    extensions = ('.png', '.jpg', '.jpeg')
+    with os.scandir(image_directory) as entries:
+        return [entry.name for entry in entries
+                if entry.is_file() and entry.name.lower().endswith(extensions)]
 
 
 if __name__ == "__main__":
@@ -199,6 +308,8 @@ if __name__ == "__main__":
             image = st.selectbox("**select input image:**", image_files)
             bg_color = st.selectbox('**select image:**', back_files)
 
+        high_quality = st.checkbox("High quality edges (slower)", value=False)
+
         col3, col4 = st.columns([5, 1])
         is_submit = False
         with col3:
@@ -209,18 +320,20 @@ if __name__ == "__main__":
                 is_submit = True
                 if is_submit:
                     if image:
-                        output_images = process_image(image, bg_color, output_image_path)
+                        output_images = process_image(image, bg_color, output_image_path, alpha_matting=high_quality)
                         if output_images:
                             with col2:
                                 output_container = st.container()
                                 with output_container:
+                                    buf = io.BytesIO()
                                     for idx, img in enumerate(output_images):
                                         st.subheader(f"Processed Image")
                                         st.image(img)
 
                                         # Add download button
-                                        buf = io.BytesIO()
-                                        img.save(buf, format="JPEG")
+                                        buf.seek(0)
+                                        buf.truncate()
+                                        img.save(buf, **JPEG_SAVE_OPTIONS)
                                         st.download_button(
                                             label="Download Passport Photo",
                                             data=buf.getvalue(),